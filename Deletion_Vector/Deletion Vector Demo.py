@@ -8,7 +8,7 @@
 # MAGIC
 # MAGIC #### Information
 # MAGIC * This notebook will need 4 parameters i.e.
-# MAGIC   * SCHEMA_NAME - Database that will be created for this demo
+# MAGIC   * SCHEMA_NAME - Database that will be created for this demo (it is dropped and re-created on every run)
 # MAGIC   * NON_DV_TABLE_NAME - Name for a Delta Table (without Deletion Vector)
 # MAGIC   * DV_TABLE - Name for a Delta Table (With Deletion Vector Enabled)
 # MAGIC   * INCREMENTAL_TABLE_NAME - Name for a Delta Table (With Incremental Datasets to act as MERGE Source)
@@ -16,10 +16,11 @@
 # MAGIC * Script will first Creare Schema, Tables and then Populate it with DUMMY Datasets
 # MAGIC   * Both Non-DV & DV tables have CDC enabled to showcase record count based on operation (Insert, Delete, Update Pre, Update Post)
 # MAGIC   * Post Initial Insert both Non-DV and DV Table will be having 100000000 records, Incremental Table will be having 101000 records
+# MAGIC   * Initial Insert writes one Parquet file per seed partition i.e. max(10, 2 x cluster cores) - file counts mentioned below assume 10
 # MAGIC   * Non-DV and DV Tables will be having name column with value starting as "Company"
 # MAGIC   * Incremental Table will be having name column with value starting as "Organization"
 # MAGIC
-# MAGIC * A MERGE function will be created to perform MERGE Test for both Non-DV and DV table
+# MAGIC * A MERGE function will be created to perform MERGE Test for both Non-DV and DV table (an insert-only MERGE for new records followed by an update/delete MERGE for existing records)
 # MAGIC * MERGE on Non-DV enabled Table will re-write the whole files and will take longer time to run (depending on cluster size)
 # MAGIC * MERGER on DV enabled Table will only write 2 extra Parquet Files and 1 Deletion Vector Bin file and will take 40-50% lesser time to execute
 # MAGIC
@@ -39,122 +40,167 @@ dbutils.widgets.text("SCHEMA_NAME", "deletion_vectors_example_database")
 dbutils.widgets.text("NON_DV_TABLE_NAME", "non_dv_example")
 dbutils.widgets.text("DV_TABLE_NAME", "dv_example")
 dbutils.widgets.text("INCREMENTAL_TABLE_NAME", "incremental_table")
+# Run the two MERGEs one after the other, so each gets the whole cluster and their times can be compared
+dbutils.widgets.dropdown("CONCURRENT_MERGES", "false", ["false", "true"])
 
 SCHEMA = dbutils.widgets.get("SCHEMA_NAME")
 NORMAL_TABLE = dbutils.widgets.get("NON_DV_TABLE_NAME")
 DV_TABLE = dbutils.widgets.get("DV_TABLE_NAME")
 INCREMETAL_TABLE = "." + dbutils.widgets.get("INCREMENTAL_TABLE_NAME")
+CONCURRENT_MERGES = dbutils.widgets.get("CONCURRENT_MERGES") == "true"
 
 # COMMAND ----------
 
 # DBTITLE 1,Prepare Environment - Database/Schema, Tables and Populate Data
 SCALE_FACTOR = 100 * 1000 * 1000
+# Seed with at least 2 partitions per core so id generation and the initial write use the whole cluster
+NUM_PARTITIONS = max(10, spark.sparkContext.defaultParallelism * 2)
 
-# CREATE A DATABASE
-spark.sql(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA}")
+# RECREATE THE DATABASE - drops any tables left over from a previous run in one statement
+spark.sql(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+spark.sql(f"CREATE SCHEMA {SCHEMA}")
 spark.sql(f"USE {SCHEMA}")
 
-
-# DROP TABLE IF ALREADY EXISTS
-spark.sql(f"DROP TABLE IF EXISTS {SCHEMA}.{NORMAL_TABLE}")
-spark.sql(f"DROP TABLE IF EXISTS {SCHEMA}.{DV_TABLE}")
-spark.sql(f"DROP TABLE IF EXISTS {SCHEMA}{INCREMETAL_TABLE}")
-
-# POPULATE NON DELETION VECTOR TABLE
-df_nondv_table = (
-    spark.range(0, SCALE_FACTOR, 1, 10)
+# BUILD THE SEED DATASET ONCE - both tables are populated from the same cached DataFrame
+# spark.range splits the ids into NUM_PARTITIONS contiguous, sorted ranges, so every output file covers a
+# disjoint id range (the layout ZORDER BY (id) would give) and the MERGE delete range
+# id BETWEEN 9000041 AND 9000655 falls inside a single file's min/max statistics.
+# sortWithinPartitions("id") pins that ordering; Spark drops the sort as range output is already sorted.
+# name stays a stored column: the MERGE writes "Organization ..." values into it (so it cannot be a
+# generated column), and it is the payload whose rewrite cost the Non-DV vs DV comparison measures.
+df_seed = (
+    spark.range(0, SCALE_FACTOR, 1, NUM_PARTITIONS)
     .toDF("id")
     .withColumn("name", concat(lit("Company "), col("id")))
+    .sortWithinPartitions("id")
+    .cache()
 )
+df_seed.count()
 
-df_nondv_table.write.option("database", SCHEMA).option(
+# POPULATE NON DELETION VECTOR TABLE
+df_seed.write.option("database", SCHEMA).option(
     "delta.enableChangeDataFeed", True
-).saveAsTable(NORMAL_TABLE)
+).option("delta.dataSkippingNumIndexedCols", 1).saveAsTable(NORMAL_TABLE)
 
 # POPULATE DELETION VECTOR TABLE
-df_dv_table = (
-    spark.range(0, SCALE_FACTOR, 1, 10)
-    .toDF("id")
-    .withColumn("name", concat(lit("Company "), col("id")))
-)
-
-df_dv_table.write.option("database", SCHEMA).option(
+df_seed.write.option("database", SCHEMA).option(
     "delta.enableDeletionVectors", True
-).option("delta.enableChangeDataFeed", True).saveAsTable(DV_TABLE)
+).option("delta.enableChangeDataFeed", True).option(
+    "delta.dataSkippingNumIndexedCols", 1
+).saveAsTable(DV_TABLE)
+
+df_seed.unpersist()
 
 # POPULATE TABLE FOR INCREMENTAL DATA
+# Existing ids with id % 1000 = 42 are generated directly with a step of 1000 instead of filtering 100M ids
+# Optimized Writes bin the many tiny range partitions into a few files for the MERGE source scan
 spark.range(SCALE_FACTOR, SCALE_FACTOR + 1000).toDF("id").union(
-    spark.range(0, SCALE_FACTOR).toDF("id").where("id % 1000 = 42")
-).withColumn("name", concat(lit("Organization "), col("id"))).write.saveAsTable(
-    SCHEMA + INCREMETAL_TABLE
-)
+    spark.range(42, SCALE_FACTOR, 1000).toDF("id")
+).withColumn("name", concat(lit("Organization "), col("id"))).write.option(
+    "delta.autoOptimize.optimizeWrite", True
+).saveAsTable(SCHEMA + INCREMETAL_TABLE)
 
 # COMMAND ----------
 
 # DBTITLE 1,VALIDATE RECORD COUNTS IN TABLES
-dftbl = sqlContext.sql("show tables")
-dfdbs = sqlContext.sql(f"Select '{SCHEMA}' as databaseName ")
-dftbls = "0"
-for row in dfdbs.rdd.collect():
-    tmp = "show tables from " + row["databaseName"]
-    dftbls = sqlContext.sql(tmp)
-
-tmplist = []
-for row in dftbls.rdd.collect():
-    try:
-        tmp = (
-            "select count(*) myrowcnt from " + row["database"] + "." + row["tableName"]
-        )
-        tmpdf = sqlContext.sql(tmp)
-        myrowcnt = tmpdf.collect()[0]["myrowcnt"]
-        tmplist.append((row["database"], row["tableName"], myrowcnt))
-    except:
-        tmplist.append((row["database"], row["tableName"], -1))
-
-columns = ["database", "tableName", "rowCount"]
-df = spark.createDataFrame(tmplist, columns)
+# List the schema's tables once and count all of them in a single UNION ALL query,
+# so the counts run as one Spark job instead of one driver round trip per table.
+# listTables also returns session temp views, which cannot be addressed as {SCHEMA}.<name>
+tables = [t.name for t in spark.catalog.listTables(SCHEMA) if not t.isTemporary]
+
+union_sql = " UNION ALL ".join(
+    f"SELECT '{SCHEMA}' AS database, '{t}' AS tableName, count(*) AS rowCount FROM {SCHEMA}.{t}"
+    for t in tables
+)
+df = spark.sql(union_sql)
 display(df)
 
 # COMMAND ----------
 
 # DBTITLE 1,CREATE SQL MERGER FUNCTION - add specific conditions to UPDATE & DELETE Data
 # CREATE A SQL MERGE FUNCTION
+# The merge runs as two statements:
+#   1. Source ids >= SCALE_FACTOR do not exist in the target and can only be INSERTED. An insert-only
+#      MERGE appends new files without rewriting any target file, and the id bound in the ON clause
+#      lets data skipping prune every existing target file from the join.
+#   2. Source ids < SCALE_FACTOR already exist in the target and are only UPDATED or DELETED, so this
+#      MERGE needs WHEN MATCHED clauses only (inner join instead of a full outer join). The source is
+#      ~100K rows, so it is broadcast and the 100M-row target is never shuffled for the join.
 
 def sql_merge(Source_Table, Target_Table):
-    target_table = {Target_Table}
     spark.sql(
         f"""
     MERGE INTO {Target_Table} t
-    USING {Source_Table} s
+    USING (SELECT * FROM {Source_Table} WHERE id >= {SCALE_FACTOR}) s
+    ON t.id = s.id AND t.id >= {SCALE_FACTOR}
+    WHEN NOT MATCHED THEN INSERT *
+  """
+    )
+    spark.sql(
+        f"""
+    MERGE INTO {Target_Table} t
+    USING (SELECT /*+ BROADCAST(src) */ * FROM {Source_Table} src WHERE id < {SCALE_FACTOR}) s
     ON t.id = s.id
     WHEN MATCHED AND t.id BETWEEN 9000041 AND 9000655 THEN DELETE
     WHEN MATCHED AND t.id NOT BETWEEN 9000041 AND 9000655 THEN UPDATE SET *
-    WHEN NOT MATCHED THEN INSERT *
   """
     )
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### Perform MERGE on NON DELETION VECTOR TABLE
-# MAGIC Note down the time it took - Later compare it with Deletion Vector enabled table, **CMD 11**
+# MAGIC ### Perform MERGE on NON DELETION VECTOR and DELETION VECTOR TABLES
+# MAGIC By default the MERGEs run one after the other - compare the time each one took, the Deletion Vector enabled table will certainly be 40-50% lesser than Non-Deletion Vector table
+# MAGIC
+# MAGIC Set `CONCURRENT_MERGES` to `true` to run both MERGEs at the same time in their own FAIR scheduler pool. This finishes sooner, but the two MERGEs then share the cluster, so their times are no longer comparable
 
 # COMMAND ----------
 
-# DBTITLE 1,Perform MERGE on NON DELETION VECTOR TABLE
+# DBTITLE 1,Perform MERGE on NON DELETION VECTOR and DELETION VECTOR TABLES
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 Source_Table = SCHEMA + INCREMETAL_TABLE
-Target_Table = SCHEMA + "." + NORMAL_TABLE
 
-sql_merge(Source_Table, Target_Table)
+# Each MERGE submits its jobs to its own scheduler pool and reports how long it took
+def timed_merge(pool, Target_Table):
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", pool)
+    start = time.time()
+    sql_merge(Source_Table, Target_Table)
+    return time.time() - start
+
+if CONCURRENT_MERGES:
+    # The two targets share no files, so both MERGEs can run at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        non_dv_merge = executor.submit(timed_merge, "non_dv_merge", SCHEMA + "." + NORMAL_TABLE)
+        dv_merge = executor.submit(timed_merge, "dv_merge", SCHEMA + "." + DV_TABLE)
+    non_dv_merge_time, dv_merge_time = non_dv_merge.result(), dv_merge.result()
+else:
+    non_dv_merge_time = timed_merge("non_dv_merge", SCHEMA + "." + NORMAL_TABLE)
+    dv_merge_time = timed_merge("dv_merge", SCHEMA + "." + DV_TABLE)
+
+print(f"MERGE on NON DELETION VECTOR TABLE took {non_dv_merge_time:.1f} seconds")
+print(f"MERGE on DELETION VECTOR TABLE took {dv_merge_time:.1f} seconds")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Review MERGE on NON DELETION VECTOR TABLE
+
+# COMMAND ----------
+
+Target_Table = SCHEMA + "." + NORMAL_TABLE
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC ### Check operationMetrics Column
-# MAGIC #### We will see 2 Version
+# MAGIC #### We will see 3 Version
 # MAGIC  **Version 0** - Initial CREATE TABLE  - Which must have added around 10 files 
 # MAGIC  
-# MAGIC  **Version 1** - MERGE Statement - Will remove existing 10 files and re-write new 10-20 new files which is the default behavior and is expensive as every change need to re-write complete dataset.
+# MAGIC  **Version 1** - Insert-only MERGE Statement - Will add 1 new file with the New Records and will not re-write any existing file (check numTargetFilesRemoved = 0)
+# MAGIC  
+# MAGIC  **Version 2** - Update/Delete MERGE Statement - Will remove existing 10 files and re-write new 10-20 new files which is the default behavior and is expensive as every change need to re-write complete dataset.
 # MAGIC
 # MAGIC **Deleted Records will be  : 1 (Id = 9000042 )**
 # MAGIC
@@ -173,31 +219,37 @@ display(df)
 
 # COMMAND ----------
 
-# DBTITLE 1,Count of Record Group By CHANGE TYPE (Insert, Update Pre/Post & Delete)
-df = spark.sql(f"SELECT _change_type,count(*) FROM table_changes('{Target_Table}',1) Group By _change_type")
+# DBTITLE 1,Count of Records By CHANGE TYPE (Insert, Update Pre/Post & Delete)
+df = spark.sql(
+    f"""
+    SELECT count_if(_change_type = 'insert') AS inserted,
+      count_if(_change_type = 'delete') AS deleted,
+      count_if(_change_type = 'update_preimage') AS update_preimage,
+      count_if(_change_type = 'update_postimage') AS update_postimage
+    FROM table_changes('{Target_Table}', 1)
+  """
+)
 display(df)
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### Perform MERGE on DELETION VECTOR TABLE
-# MAGIC Note down the time it took - Which will certainly be 40-50% lesser than Non-Deletion Vector Enabled Cluster from above execution, **CMD 7**
+# MAGIC ### Review MERGE on DELETION VECTOR TABLE
 
 # COMMAND ----------
 
-Source_Table = SCHEMA + INCREMETAL_TABLE
 Target_Table = SCHEMA + "." + DV_TABLE
 
-sql_merge(Source_Table, Target_Table)
-
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC ### Check operationMetrics Column
-# MAGIC #### We will see 2 Version
+# MAGIC #### We will see 3 Version
 # MAGIC  **Version 0** - Initial CREATE TABLE  - Which must have added around 10 files 
 # MAGIC  
-# MAGIC  **Version 1** - MERGE Statement - Will add new 2 new files(for Updated Records & New Records). This time it has not re-written whole dataset and that is what Deletion Vector brings on the table.
+# MAGIC  **Version 1** - Insert-only MERGE Statement - Will add 1 new file with the New Records and will not re-write any existing file (check numTargetFilesRemoved = 0)
+# MAGIC  
+# MAGIC  **Version 2** - Update/Delete MERGE Statement - Will add 1 new file for Updated Records. This time it has not re-written whole dataset and that is what Deletion Vector brings on the table.
 # MAGIC
 # MAGIC **Deleted Records will be  : 1 (Id = 9000042 )**
 # MAGIC
@@ -213,9 +265,15 @@ display(df)
 
 # COMMAND ----------
 
-# DBTITLE 1,Count of Record Group By CHANGE TYPE (Insert, Update Pre/Post & Delete)
+# DBTITLE 1,Count of Records By CHANGE TYPE (Insert, Update Pre/Post & Delete)
 df = spark.sql(
-    f"SELECT _change_type,count(*) FROM table_changes('{Target_Table}',1) Group By _change_type"
+    f"""
+    SELECT count_if(_change_type = 'insert') AS inserted,
+      count_if(_change_type = 'delete') AS deleted,
+      count_if(_change_type = 'update_preimage') AS update_preimage,
+      count_if(_change_type = 'update_postimage') AS update_postimage
+    FROM table_changes('{Target_Table}', 1)
+  """
 )
 display(df)
 
@@ -236,9 +294,10 @@ display(df)
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ####Lets Review Delta Log Files - We should have 2 of them
+# MAGIC ####Lets Review Delta Log Files - We should have 3 of them
 # MAGIC * 00000000000000000000.json - From initial table creation operation (with 10 Parquet files)
-# MAGIC * 00000000000000000001.json - From MERGE operation (2 new Parquet files)
+# MAGIC * 00000000000000000001.json - From insert-only MERGE operation (1 new Parquet file)
+# MAGIC * 00000000000000000002.json - From update/delete MERGE operation (1 new Parquet file and the existing files re-added with their Deletion Vectors)
 
 # COMMAND ----------
 
@@ -247,34 +306,56 @@ display(df)
 
 # COMMAND ----------
 
-# DBTITLE 1,First VERSION of file will show 10 parquet files from initial write
-display(spark.read.json(f"dbfs:/user/hive/warehouse/{SCHEMA}.db/{DV_TABLE}/_delta_log/00000000000000000000.json").where("add is not null").select("add.path"))
+# DBTITLE 1,Helper to read the files added by a Delta Log commit
+import json
+
+LOG_DIR = f"dbfs:/user/hive/warehouse/{SCHEMA}.db/{DV_TABLE}/_delta_log"
+
+# A commit file is a few KB of newline-delimited JSON actions, so parse it on the driver
+# instead of submitting a Spark job through spark.read.json
+def delta_log_adds(version):
+    commit = dbutils.fs.head(f"{LOG_DIR}/{version:020d}.json", 10 * 1024 * 1024)
+    actions = [json.loads(line) for line in commit.splitlines()]
+    return [action["add"] for action in actions if "add" in action]
+
+# Read each commit once and reuse the parsed add actions in the cells below
+v0, v1, v2 = delta_log_adds(0), delta_log_adds(1), delta_log_adds(2)
 
 # COMMAND ----------
 
-# DBTITLE 1,Second VERSION of file will show 12 parquet files (10 from initial writes and 2 new)
-display(spark.read.json(f"dbfs:/user/hive/warehouse/{SCHEMA}.db/{DV_TABLE}/_delta_log/00000000000000000001.json").where("add is not null").select("add.path"))
+# DBTITLE 1,First VERSION of file will show 10 parquet files from initial write
+display(spark.createDataFrame([(add["path"],) for add in v0], "path STRING"))
 
 # COMMAND ----------
 
-# DBTITLE 1,Code will read Version 0 JSON file and fetch 10th file and show its contents which are all UPDATED records = 99999
-import pyspark
-from pyspark.sql import Row
+# DBTITLE 1,Second VERSION of file will show 1 parquet file (newly inserted records)
+display(spark.createDataFrame([(add["path"],) for add in v1], "path STRING"))
 
-spark.conf.set("spark.databricks.delta.formatCheck.enabled", "false")
+# COMMAND ----------
 
-df = spark.read.json(f"dbfs:/user/hive/warehouse/{SCHEMA}.db/{DV_TABLE}/_delta_log/00000000000000000001.json").where("add is not null").select("add.path")
-x = df.collect()[10].__getitem__('path')
-display(spark.read.parquet(f"dbfs:/user/hive/warehouse/{SCHEMA}.db/{DV_TABLE}/{x}").count())
+# DBTITLE 1,Third VERSION of file will show 11 parquet files (10 from initial writes with Deletion Vectors and 1 new)
+display(
+    spark.createDataFrame(
+        [
+            (add["path"], (add.get("deletionVector") or {}).get("cardinality"))
+            for add in v2
+        ],
+        "path STRING, deletedRows LONG",
+    )
+)
 
 # COMMAND ----------
 
-# DBTITLE 1,Code will read Version 1 JSON file and fetch 11th file and show its contents which are all NEWLY inserted records = 1000
-import pyspark
-from pyspark.sql import Row
+# DBTITLE 1,Code will read Version 2 JSON file and fetch the new file (no Deletion Vector) and show its contents which are all UPDATED records = 99999
+import pyarrow.parquet as pq
 
-spark.conf.set("spark.databricks.delta.formatCheck.enabled", "false")
+# The row count is stored in the Parquet footer, so read only the footer through the /dbfs mount
+# instead of running a Spark job that scans the file
+paths = [add["path"] for add in v2 if add.get("deletionVector") is None]
+print(pq.ParquetFile(f"/dbfs/user/hive/warehouse/{SCHEMA}.db/{DV_TABLE}/{paths[0]}").metadata.num_rows)
+
+# COMMAND ----------
 
-df = spark.read.json(f"dbfs:/user/hive/warehouse/{SCHEMA}.db/{DV_TABLE}/_delta_log/00000000000000000001.json").where("add is not null").select("add.path")
-x = df.collect()[11].__getitem__('path')
-display(spark.read.parquet(f"dbfs:/user/hive/warehouse/{SCHEMA}.db/{DV_TABLE}/{x}").count())
+# DBTITLE 1,Code will read Version 1 JSON file and fetch the new file and show its contents which are all NEWLY inserted records = 1000
+paths = [add["path"] for add in v1]
+print(pq.ParquetFile(f"/dbfs/user/hive/warehouse/{SCHEMA}.db/{DV_TABLE}/{paths[0]}").metadata.num_rows)
@@ -91,6 +91,7 @@ CATALOG = "main"
 SCHEMA = "openai_experimentation"
 TABLE_RAW_REVIEWS = "raw_amazon_reviews_pds"
 SEED = "123456"
+ANNOTATE_BATCH_SIZE = "10"
 
 
 dbutils.widgets.removeAll()
@@ -98,6 +99,7 @@ dbutils.widgets.text("catalog", CATALOG, "Catalog")
 dbutils.widgets.text("schema", SCHEMA, "Schema")
 dbutils.widgets.text("raw_reviews_table", TABLE_RAW_REVIEWS, "Target table for Review Data")
 dbutils.widgets.text("seed", SEED, "Random seed for reproducibility")
+dbutils.widgets.text("annotate_batch_size", ANNOTATE_BATCH_SIZE, "Reviews annotated per Azure OpenAI call")
 
 
 # COMMAND ----------
@@ -110,6 +112,11 @@ USE SCHEMA ${schema};
 # COMMAND ----------
 
 # MAGIC %sql
+# MAGIC -- Larger splits let each task read more of a file's adjacent column chunks together,
+# MAGIC -- and the disk cache keeps the files read from S3 on the workers' local SSDs for the queries that follow
+# MAGIC SET spark.sql.files.maxPartitionBytes = 256m;
+# MAGIC SET spark.databricks.io.cache.enabled = true;
+# MAGIC
 # MAGIC CREATE TABLE IF NOT EXISTS $raw_reviews_table
 # MAGIC COMMENT "Raw data: customer reviews";
 # MAGIC
@@ -118,9 +125,24 @@ USE SCHEMA ${schema};
 # MAGIC FILEFORMAT = PARQUET
 # MAGIC FORMAT_OPTIONS ('inferSchema' = 'true')
 # MAGIC COPY_OPTIONS ('mergeSchema' = 'true');
-# MAGIC
-# MAGIC OPTIMIZE $raw_reviews_table;
-# MAGIC ANALYZE TABLE $raw_reviews_table COMPUTE STATISTICS;
+
+# COMMAND ----------
+
+# DBTITLE 1,Cluster the raw reviews by product_category
+# Every query below filters on product_category: cluster the files by it so that only the Grocery files are read
+# The table only has columns once COPY INTO has inferred them, hence the ALTER TABLE rather than CLUSTER BY at creation
+raw_reviews_table = dbutils.widgets.get("raw_reviews_table")
+clustering_columns = spark.sql(f"DESCRIBE DETAIL {raw_reviews_table}").first()["clusteringColumns"]
+
+if clustering_columns != ["product_category"]:
+    spark.sql(f"ALTER TABLE {raw_reviews_table} CLUSTER BY (product_category)")
+    # FULL also reclusters the rows loaded before clustering was enabled, which is only needed this once
+    spark.sql(f"OPTIMIZE {raw_reviews_table} FULL")
+else:
+    # Later loads only need the files they added clustered
+    spark.sql(f"OPTIMIZE {raw_reviews_table}")
+
+spark.sql(f"ANALYZE TABLE {raw_reviews_table} COMPUTE STATISTICS")
 
 # COMMAND ----------
 
@@ -177,7 +199,7 @@ USE SCHEMA ${schema};
 # MAGIC - Asking it a well-formed question
 # MAGIC - Being specific about the type of answer that you are expecting
 # MAGIC
-# MAGIC In order to get results in a form that we can easily store in a table, we'll ask the model to return the result in a string that reflects `JSON` representation, and be very specific of the schema that we expect
+# MAGIC In order to get results in a form that we can easily store in a table, we'll ask the model to return the result in a string that reflects `JSON` representation, and be very specific of the schema that we expect. The call is made in JSON mode (`PROMPT_HANDLER_JSON()` below), so the model can only return valid JSON and the prompt doesn't need to insist on it
 # MAGIC
 # MAGIC Here's the prompt we've settled on:
 # MAGIC ```
@@ -187,7 +209,7 @@ USE SCHEMA ${schema};
 # MAGIC - whether customer requires a follow-up: Y or N
 # MAGIC - reason for requiring followup
 # MAGIC
-# MAGIC Return JSON ONLY. No other text outside the JSON. JSON format:
+# MAGIC Return JSON in this format:
 # MAGIC {
 # MAGIC entities: [{
 # MAGIC     "entity_name": <entity name>,
@@ -204,10 +226,23 @@ USE SCHEMA ${schema};
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Serve Azure OpenAI from Model Serving
+# MAGIC
+# MAGIC The pipeline below calls Azure OpenAI with `ai_query()` through Model Serving endpoints, rather than with `AI_GENERATE_TEXT()`. `ai_query()` batches and parallelises the requests of a query itself, retries throttled ones, and with `failOnError => false` returns NULL for a failed row instead of failing the whole query
+# MAGIC
+# MAGIC - Navigate to `Serving` > `Create serving endpoint` and create two endpoints with an **External model** served entity, provider **Azure OpenAI**, task **llm/v1/chat**:
+# MAGIC   - `llmbricks-gpt-35-turbo`: deployment `llmbricks`
+# MAGIC   - `llmbricks-small`: deployment `llmbricks-small`, a smaller, cheaper model
+# MAGIC - For both, use resource name `llmbricks`, API version `2024-02-01` (needed for JSON mode), and reference your key as `{{secrets/<<SCOPE NAME>>/<<OPEN_AI_KEY>>}}` so it is only read by the endpoint
+# MAGIC - Grant `CAN QUERY` on the endpoints to the `openai-users` group
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## SQL Functions
 # MAGIC
-# MAGIC - We'll create SQL functions in order to abstract away the details of the `AI_GENERATE_TEXT()` call from the end users
+# MAGIC - We'll create SQL functions in order to abstract away the details of the `ai_query()` call from the end users
 
 # COMMAND ----------
 
@@ -215,16 +250,58 @@ USE SCHEMA ${schema};
 # MAGIC
 # MAGIC -- Wrapper function to handle all our calls to Azure OpenAI
 # MAGIC -- Analysts who want to use arbitrary prompts can use this handler
+# MAGIC -- Failed calls return NULL, so they are retried on the next run instead of failing the pipeline
 # MAGIC CREATE OR REPLACE FUNCTION PROMPT_HANDLER(prompt STRING)
 # MAGIC RETURNS STRING
-# MAGIC RETURN AI_GENERATE_TEXT(prompt,
-# MAGIC   "azure_openai/gpt-35-turbo",
-# MAGIC   "apiKey", SECRET("SCOPE NAME", "OPEN API KEY VALUE"),
-# MAGIC   "temperature", CAST(0.0 AS DOUBLE),
-# MAGIC   "deploymentName", "llmbricks",
-# MAGIC   "apiVersion", "2023-03-15-preview",  
-# MAGIC   "resourceName", "llmbricks"
-# MAGIC );
+# MAGIC RETURN ai_query("llmbricks-gpt-35-turbo", prompt,
+# MAGIC   modelParameters => NAMED_STRUCT("temperature", CAST(0.0 AS DOUBLE)),
+# MAGIC   failOnError => false
+# MAGIC ).result;
+# MAGIC
+# MAGIC
+# MAGIC -- Same as PROMPT_HANDLER, but for simple classification and lookup prompts (Y/N answers, lists of names):
+# MAGIC -- "llmbricks-small" serves a smaller, cheaper and faster model than "llmbricks-gpt-35-turbo"
+# MAGIC CREATE OR REPLACE FUNCTION PROMPT_HANDLER_SMALL(prompt STRING)
+# MAGIC RETURNS STRING
+# MAGIC RETURN ai_query("llmbricks-small", prompt,
+# MAGIC   modelParameters => NAMED_STRUCT("temperature", CAST(0.0 AS DOUBLE)),
+# MAGIC   failOnError => false
+# MAGIC ).result;
+# MAGIC
+# MAGIC
+# MAGIC -- Same as PROMPT_HANDLER, for prompts that ask for a short free-text reply such as a message to a customer:
+# MAGIC -- the reply is capped at 180 tokens and cut at the first stop sequence, so overly long generations don't hold up the query
+# MAGIC CREATE OR REPLACE FUNCTION PROMPT_HANDLER_SHORT(prompt STRING)
+# MAGIC RETURNS STRING
+# MAGIC RETURN ai_query("llmbricks-gpt-35-turbo", prompt,
+# MAGIC   modelParameters => NAMED_STRUCT(
+# MAGIC     "temperature", CAST(0.0 AS DOUBLE),
+# MAGIC     "max_tokens", 180,
+# MAGIC     "stop", ARRAY("\n\nCustomer:", "###")),
+# MAGIC   failOnError => false
+# MAGIC ).result;
+# MAGIC
+# MAGIC
+# MAGIC -- Same as PROMPT_HANDLER, but the model is constrained to return a single valid JSON object (Azure OpenAI JSON mode)
+# MAGIC -- so the response always parses with FROM_JSON. The prompt must still mention JSON and describe the expected format
+# MAGIC -- Requires a model version and an API version that support JSON mode (gpt-35-turbo 1106 and 2023-12-01-preview or later)
+# MAGIC CREATE OR REPLACE FUNCTION PROMPT_HANDLER_JSON(prompt STRING)
+# MAGIC RETURNS STRING
+# MAGIC RETURN ai_query("llmbricks-gpt-35-turbo", prompt,
+# MAGIC   modelParameters => NAMED_STRUCT("temperature", CAST(0.0 AS DOUBLE)),
+# MAGIC   responseFormat => '{"type": "json_object"}',
+# MAGIC   failOnError => false
+# MAGIC ).result;
+# MAGIC
+# MAGIC
+# MAGIC -- Caps a review at about 1200 characters (~300 tokens) before it is put in a prompt, since the latency of a call grows
+# MAGIC -- with the length of its prompt. Long reviews keep their beginning and their end, where the verdict usually is
+# MAGIC CREATE OR REPLACE FUNCTION TRUNCATE_REVIEW(review STRING)
+# MAGIC RETURNS STRING
+# MAGIC RETURN CASE
+# MAGIC   WHEN LENGTH(review) <= 1200 THEN review
+# MAGIC   ELSE CONCAT(LEFT(review, 900), ' ... ', RIGHT(review, 300))
+# MAGIC END;
 # MAGIC
 # MAGIC
 # MAGIC -- Extracts entities, entity sentiment, and whether follow-up is required from a customer review
@@ -233,14 +310,14 @@ USE SCHEMA ${schema};
 # MAGIC CREATE OR REPLACE FUNCTION ANNOTATE_REVIEW(review STRING)
 # MAGIC RETURNS STRUCT<entities: ARRAY<STRUCT<entity_name: STRING, entity_type: STRING, entity_sentiment: STRING, followup: STRING, followup_reason: STRING>>>
 # MAGIC RETURN FROM_JSON(
-# MAGIC   PROMPT_HANDLER(CONCAT(
+# MAGIC   PROMPT_HANDLER_JSON(CONCAT(
 # MAGIC     'A customer left a review. We follow up with anyone who appears unhappy.
 # MAGIC      Extract all entities mentioned. For each entity:
 # MAGIC       - classify sentiment as ["POSITIVE","NEUTRAL","NEGATIVE"]
 # MAGIC       - whether customer requires a follow-up: Y or N
 # MAGIC       - reason for requiring followup
 # MAGIC
-# MAGIC     Return JSON ONLY. No other text outside the JSON. JSON format:
+# MAGIC     Return JSON in this format:
 # MAGIC     {
 # MAGIC         entities: [{
 # MAGIC             "entity_name": <entity name>,
@@ -252,29 +329,113 @@ USE SCHEMA ${schema};
 # MAGIC     }
 # MAGIC
 # MAGIC     Review:
-# MAGIC     ', review)),
+# MAGIC     ', TRUNCATE_REVIEW(review))),
 # MAGIC   "STRUCT<entities: ARRAY<STRUCT<entity_name: STRING, entity_type: STRING, entity_sentiment: STRING, followup: STRING, followup_reason: STRING>>>"
 # MAGIC );
 # MAGIC
 # MAGIC
+# MAGIC -- Same as ANNOTATE_REVIEW, but annotates a whole batch of reviews with a single call to Azure OpenAI
+# MAGIC -- The reviews are numbered in the prompt and the model returns one JSON object per review, keyed by its id
+# MAGIC -- When a review needs a follow-up, the same call also drafts the response to the customer,
+# MAGIC -- so the Gold layer does not need a second, dependent call to GENERATE_RESPONSE
+# MAGIC -- A missing product or text is left blank rather than dropping its review from the prompt
+# MAGIC -- The prompt and the parsing of the response are separate functions so other callers (see the cluster section below) can reuse them
+# MAGIC CREATE OR REPLACE FUNCTION ANNOTATE_REVIEWS_PROMPT(reviews ARRAY<STRUCT<id: STRING, product: STRING, body: STRING>>)
+# MAGIC RETURNS STRING
+# MAGIC RETURN CONCAT(
+# MAGIC     'Customers left the reviews below. We follow up with anyone who appears unhappy.
+# MAGIC      For each review, extract all entities mentioned. For each entity:
+# MAGIC       - classify sentiment as ["POSITIVE","NEUTRAL","NEGATIVE"]
+# MAGIC       - whether customer requires a follow-up: Y or N
+# MAGIC       - reason for requiring followup
+# MAGIC      If any entity of a review requires a follow-up, also recommend alternative products for the reviewed product
+# MAGIC      in the tone of an empathetic message back to the customer; only provide the body, in at most 80 words.
+# MAGIC      Otherwise leave it null.
+# MAGIC
+# MAGIC     Return one object per review, with its review_id, as JSON in this format:
+# MAGIC     {
+# MAGIC         reviews: [{
+# MAGIC             "review_id": <review id>,
+# MAGIC             "entities": [{
+# MAGIC                 "entity_name": <entity name>,
+# MAGIC                 "entity_type": <entity type>,
+# MAGIC                 "entity_sentiment": <entity sentiment>,
+# MAGIC                 "followup": <Y or N for follow up>,
+# MAGIC                 "followup_reason": <reason for followup>
+# MAGIC             }],
+# MAGIC             "followup_response": <response to the customer or null>
+# MAGIC         }]
+# MAGIC     }
+# MAGIC
+# MAGIC     Reviews:
+# MAGIC     ', ARRAY_JOIN(TRANSFORM(reviews, (r, i) -> CONCAT(i + 1, '. review_id: ', r.id, '\nproduct: ', COALESCE(r.product, ''), '\n', COALESCE(TRUNCATE_REVIEW(r.body), ''))), '\n\n'));
+# MAGIC
+# MAGIC CREATE OR REPLACE FUNCTION PARSE_REVIEWS_ANNOTATIONS(response STRING)
+# MAGIC RETURNS ARRAY<STRUCT<review_id: STRING, entities: ARRAY<STRUCT<entity_name: STRING, entity_type: STRING, entity_sentiment: STRING, followup: STRING, followup_reason: STRING>>, followup_response: STRING>>
+# MAGIC RETURN FROM_JSON(response,
+# MAGIC   "STRUCT<reviews: ARRAY<STRUCT<review_id: STRING, entities: ARRAY<STRUCT<entity_name: STRING, entity_type: STRING, entity_sentiment: STRING, followup: STRING, followup_reason: STRING>>, followup_response: STRING>>>"
+# MAGIC ).reviews;
+# MAGIC
+# MAGIC CREATE OR REPLACE FUNCTION ANNOTATE_REVIEWS_BATCH(reviews ARRAY<STRUCT<id: STRING, product: STRING, body: STRING>>)
+# MAGIC RETURNS ARRAY<STRUCT<review_id: STRING, entities: ARRAY<STRUCT<entity_name: STRING, entity_type: STRING, entity_sentiment: STRING, followup: STRING, followup_reason: STRING>>, followup_response: STRING>>
+# MAGIC RETURN PARSE_REVIEWS_ANNOTATIONS(PROMPT_HANDLER_JSON(ANNOTATE_REVIEWS_PROMPT(reviews)));
+# MAGIC
+# MAGIC
+# MAGIC -- Annotates a single review and drafts the follow-up response in one call to Azure OpenAI
+# MAGIC CREATE OR REPLACE FUNCTION ANNOTATE_AND_RESPOND(review STRING, product STRING)
+# MAGIC RETURNS STRUCT<entities: ARRAY<STRUCT<entity_name: STRING, entity_type: STRING, entity_sentiment: STRING, followup: STRING, followup_reason: STRING>>, followup_response: STRING>
+# MAGIC RETURN TRY_ELEMENT_AT(TRANSFORM(
+# MAGIC   ANNOTATE_REVIEWS_BATCH(ARRAY(NAMED_STRUCT('id', '1', 'product', product, 'body', review))),
+# MAGIC   r -> STRUCT(r.entities AS entities, r.followup_response AS followup_response)), 1);
+# MAGIC
+# MAGIC -- Key of a review's annotation in llm_response_cache: a hash of the prompt it would be annotated with on its own,
+# MAGIC -- so that editing ANNOTATE_REVIEWS_PROMPT or TRUNCATE_REVIEW makes the responses to the old prompt cache misses
+# MAGIC CREATE OR REPLACE FUNCTION ANNOTATE_PROMPT_SHA256(review STRING, product STRING)
+# MAGIC RETURNS STRING
+# MAGIC RETURN SHA2(ANNOTATE_REVIEWS_PROMPT(ARRAY(NAMED_STRUCT('id', '', 'product', product, 'body', review))), 256);
+# MAGIC
+# MAGIC
+# MAGIC -- Prompt asking for a response to a customer based on their complaint
+# MAGIC -- Kept apart from the call so the prompt can be hashed and looked up in llm_response_cache before calling Azure OpenAI
+# MAGIC CREATE OR REPLACE FUNCTION MAKE_RESPONSE_PROMPT(product STRING, entity STRING, reason STRING)
+# MAGIC RETURNS STRING
+# MAGIC RETURN CONCAT("What alternative products can you recommend for ", product,
+# MAGIC   " when a customer had a complaint about ", entity, " because ", reason,
+# MAGIC   "Give me a response in the tone of an empathetic message back to the customer; only provide the body");
+# MAGIC
 # MAGIC -- Generate a response to a customer based on their complaint
 # MAGIC CREATE OR REPLACE FUNCTION GENERATE_RESPONSE(product STRING, entity STRING, reason STRING)
 # MAGIC RETURNS STRING
-# MAGIC RETURN PROMPT_HANDLER(
-# MAGIC   CONCAT("What alternative products can you recommend for ", product,
-# MAGIC     " when a customer had a complaint about ", entity, " because ", reason,
-# MAGIC     "Give me a response in the tone of an empathetic message back to the customer; only provide the body")
-# MAGIC );
+# MAGIC RETURN PROMPT_HANDLER_SHORT(MAKE_RESPONSE_PROMPT(product, entity, reason));
+# MAGIC
+# MAGIC
+# MAGIC -- Known brands, matched as whole words regardless of case
+# MAGIC -- Add brands with e.g. INSERT INTO brand_dict (brand) VALUES ("Country Choice"), ("Nature Valley")
+# MAGIC CREATE TABLE IF NOT EXISTS brand_dict (
+# MAGIC   brand STRING,
+# MAGIC   pattern STRING GENERATED ALWAYS AS (CONCAT('(?i)\\b\\Q', brand, '\\E\\b'))
+# MAGIC )
+# MAGIC COMMENT "Dictionary of known product brands";
 # MAGIC
+# MAGIC -- Known brands mentioned in a given piece of text, without calling Azure OpenAI
+# MAGIC CREATE OR REPLACE FUNCTION MATCH_BRANDS(text STRING)
+# MAGIC RETURNS ARRAY<STRING>
+# MAGIC RETURN TRANSFORM(
+# MAGIC   FILTER((SELECT COLLECT_LIST(STRUCT(brand, pattern)) FROM brand_dict), b -> text RLIKE b.pattern),
+# MAGIC   b -> b.brand);
 # MAGIC
 # MAGIC -- Detect product brands in a given piece of text
+# MAGIC -- Texts that mention no known brand fall back to Azure OpenAI
 # MAGIC CREATE OR REPLACE FUNCTION DETECT_BRANDS(text STRING)
 # MAGIC RETURNS ARRAY<STRING>
-# MAGIC RETURN FROM_JSON(
-# MAGIC   PROMPT_HANDLER(
-# MAGIC     CONCAT('Detect brand names in this text and return array of correctly spelt names. Text:', text)
-# MAGIC   ), "array<string>"
-# MAGIC );
+# MAGIC RETURN CASE
+# MAGIC   WHEN SIZE(MATCH_BRANDS(text)) > 0 THEN MATCH_BRANDS(text)
+# MAGIC   ELSE FROM_JSON(
+# MAGIC     PROMPT_HANDLER_SMALL(
+# MAGIC       CONCAT('Detect brand names in this text and return array of correctly spelt names. Text:', text)
+# MAGIC     ), "array<string>"
+# MAGIC   )
+# MAGIC END;
 
 # COMMAND ----------
 
@@ -307,15 +468,24 @@ USE SCHEMA ${schema};
 
 # COMMAND ----------
 
+# DBTITLE 1,ANNOTATE_AND_RESPOND() to classify a review and draft the follow-up in one call
+# MAGIC %sql
+# MAGIC SELECT review_body, ANNOTATE_AND_RESPOND(review_body, product_title) AS annotations
+# MAGIC FROM $raw_review_table
+# MAGIC WHERE product_category = "Grocery"
+# MAGIC LIMIT 3;
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ### AdHoc Queries
-# MAGIC Analysts can use the `PROMPT_HANDLER()` function we created earlier to apply their own prompts to the data
+# MAGIC Analysts can use the `PROMPT_HANDLER()` function we created earlier to apply their own prompts to the data, or `PROMPT_HANDLER_SMALL()` for simple questions such as Y/N classifications
 
 # COMMAND ----------
 
 # MAGIC %sql
 # MAGIC SELECT review_id,
-# MAGIC   PROMPT_HANDLER(
+# MAGIC   PROMPT_HANDLER_SMALL(
 # MAGIC     CONCAT(
 # MAGIC       "Does this review discuss beverages? Exclude non-alcoholic products. Answer Y or N only, no explanations or notes. Review: ", 
 # MAGIC       review_body)
@@ -348,21 +518,37 @@ USE SCHEMA ${schema};
 
 # COMMAND ----------
 
-# DBTITLE 1,Load approx. 10 random rows to experiment with
+# DBTITLE 1,Load 10 random rows to experiment with
 # MAGIC %sql
+# MAGIC -- The 10 Grocery reviews with the smallest hash of review_id and the seed: always the same ones for a given seed,
+# MAGIC -- and a fixed number of reviews for the LLM steps below to be called on
+# MAGIC -- The hash filter keeps about 1 in 24,000 reviews (~100 rows) so that only those candidates are sorted
 # MAGIC CREATE OR REPLACE TABLE bronze_customer_reviews_grocery
 # MAGIC COMMENT "Raw data: A sample of Grocery-related reviews from Amazon's Customer Reviews Dataset"
 # MAGIC AS WITH grocery_reviews AS (
-# MAGIC   SELECT * FROM $data_table WHERE product_category IN ("Grocery")
+# MAGIC   SELECT *, CRC32(CONCAT(review_id, '$seed')) AS sample_hash
+# MAGIC   FROM $data_table WHERE product_category IN ("Grocery")
 # MAGIC )
-# MAGIC SELECT * FROM grocery_reviews TABLESAMPLE (0.00041623690206528424 PERCENT) REPEATABLE ($seed); -- Get approx. 10 random rows
+# MAGIC SELECT * EXCEPT(sample_hash) FROM grocery_reviews
+# MAGIC WHERE PMOD(sample_hash, 24000) = 0
+# MAGIC ORDER BY sample_hash, review_id
+# MAGIC LIMIT 10; -- Get 10 random rows
 
 # COMMAND ----------
 
 # DBTITLE 1,Use this later to generate more data to demonstrate incremental pipelines
 # MAGIC %sql
-# MAGIC WITH sample AS (SELECT * FROM $data_table WHERE product_category IN ("Grocery")),
-# MAGIC subset AS (SELECT * FROM sample TABLESAMPLE (0.00041623690206528424 PERCENT))
+# MAGIC -- Salted with the current time so that every run picks a different subset of 10 reviews
+# MAGIC WITH sample AS (
+# MAGIC   SELECT *, CRC32(CONCAT(review_id, CAST(CURRENT_TIMESTAMP() AS STRING))) AS sample_hash
+# MAGIC   FROM $data_table WHERE product_category IN ("Grocery")
+# MAGIC ),
+# MAGIC subset AS (
+# MAGIC   SELECT * EXCEPT(sample_hash) FROM sample
+# MAGIC   WHERE PMOD(sample_hash, 24000) = 0
+# MAGIC   ORDER BY sample_hash, review_id
+# MAGIC   LIMIT 10
+# MAGIC )
 # MAGIC MERGE INTO bronze_customer_reviews_grocery b USING subset s ON s.review_id = b.review_id
 # MAGIC WHEN NOT MATCHED THEN INSERT *
 
@@ -383,21 +569,137 @@ USE SCHEMA ${schema};
 # MAGIC - sentiment per entity
 # MAGIC - whether a review requires a follow-up
 # MAGIC - reason for the follow-up
+# MAGIC - a draft response for reviews that require a follow-up, produced by the same call so the Gold layer does not call Azure OpenAI again
+# MAGIC
+# MAGIC Only reviews that pass a cheap pre-filter (`IS_FOLLOWUP_CANDIDATE()`: a low star rating or negative wording) can require a follow-up, so only those are sent to Azure OpenAI. The others are loaded with empty annotations
+# MAGIC
+# MAGIC To keep the number of Azure OpenAI round trips (and requests-per-minute quota) down, new reviews are annotated in batches of `annotate_batch_size` reviews (at most 10) per call with `ANNOTATE_REVIEWS_BATCH()`. The reviews of a batch whose response cannot be parsed are annotated again one per call
+# MAGIC
+# MAGIC Responses are stored in `llm_response_cache`, keyed by a SHA-256 hash of the prompt, the model serving endpoint and its parameters, so a review (product and text) that was already answered is never sent to Azure OpenAI again. Changing the prompt changes the hash, so the reviews are annotated again with the new prompt
 
 # COMMAND ----------
 
 # MAGIC %sql
 # MAGIC CREATE TABLE IF NOT EXISTS silver_reviews_annotated
+# MAGIC CLUSTER BY (review_id)
 # MAGIC COMMENT "Customer reviews annotated with entity sentiment and whether a follow-up is required"
+# MAGIC TBLPROPERTIES ('delta.enableDeletionVectors' = true, 'delta.enableRowTracking' = true)
 # MAGIC AS SELECT *, CAST(NULL AS 
 # MAGIC     STRUCT<entities: ARRAY<STRUCT<entity_name: STRING, entity_type: STRING, entity_sentiment: STRING, followup: STRING, 
-# MAGIC     followup_reason: STRING>>>) AS annotations
+# MAGIC     followup_reason: STRING>>, followup_response: STRING>) AS annotations
 # MAGIC FROM $data_table WHERE 1=0; -- Only duplicate the schema, don't copy data
+# MAGIC
+# MAGIC -- Also for a table created by an earlier version of this notebook
+# MAGIC -- Row tracking lets silver_reviews_processed below be refreshed incrementally where possible
+# MAGIC ALTER TABLE silver_reviews_annotated CLUSTER BY (review_id);
+# MAGIC ALTER TABLE silver_reviews_annotated SET TBLPROPERTIES ('delta.enableDeletionVectors' = true, 'delta.enableRowTracking' = true);
 
 # COMMAND ----------
 
 # MAGIC %sql
-# MAGIC MERGE INTO silver_reviews_annotated s USING bronze_customer_reviews_grocery b
+# MAGIC -- Azure OpenAI responses keyed by the function that produced them, a hash of their prompt, the endpoint serving the model and its parameters
+# MAGIC -- Re-runs look responses up here instead of paying for another call when the input has not changed
+# MAGIC CREATE TABLE IF NOT EXISTS llm_response_cache (
+# MAGIC   function_name STRING, prompt_sha256 STRING, model STRING, temperature DOUBLE, response STRING, created_at TIMESTAMP
+# MAGIC )
+# MAGIC CLUSTER BY (prompt_sha256)
+# MAGIC COMMENT "Cache of Azure OpenAI responses";
+
+# COMMAND ----------
+
+# DBTITLE 1,Pre-filter the reviews that could require a follow-up
+# MAGIC %sql
+# MAGIC -- A review with a high star rating and no negative wording will not be followed up, so it is not worth an Azure OpenAI call
+# MAGIC -- Reviews with a missing rating are kept, to be safe; reviews without text have nothing to annotate
+# MAGIC CREATE OR REPLACE FUNCTION IS_FOLLOWUP_CANDIDATE(star_rating INT, review_body STRING)
+# MAGIC RETURNS BOOLEAN
+# MAGIC RETURN review_body IS NOT NULL
+# MAGIC   AND COALESCE(star_rating <= 3 OR review_body RLIKE '(?i)(bad|terrible|awful|refund|broken|disappointed|worst)', TRUE);
+# MAGIC
+# MAGIC CREATE OR REPLACE TEMP VIEW candidate_reviews AS
+# MAGIC SELECT * FROM bronze_customer_reviews_grocery WHERE IS_FOLLOWUP_CANDIDATE(star_rating, review_body);
+
+# COMMAND ----------
+
+# DBTITLE 1,Annotate new reviews that are not in the cache yet
+# MAGIC %sql
+# MAGIC -- Only candidate reviews not yet in the Silver table, and whose text was never annotated before, are sent to Azure OpenAI
+# MAGIC CREATE OR REPLACE TEMP VIEW annotation_cache_misses AS
+# MAGIC WITH new_reviews AS (
+# MAGIC   SELECT b.review_id, b.product_title, b.review_body, ANNOTATE_PROMPT_SHA256(b.review_body, b.product_title) AS prompt_sha256
+# MAGIC   FROM candidate_reviews b LEFT ANTI JOIN silver_reviews_annotated s ON b.review_id = s.review_id
+# MAGIC )
+# MAGIC SELECT n.prompt_sha256, MIN(n.review_id) AS review_id, FIRST(n.product_title) AS product_title, FIRST(n.review_body) AS review_body
+# MAGIC FROM new_reviews n LEFT ANTI JOIN llm_response_cache c
+# MAGIC   ON c.function_name = 'ANNOTATE_AND_RESPOND' AND c.prompt_sha256 = n.prompt_sha256
+# MAGIC   AND c.model = 'llmbricks-gpt-35-turbo' AND c.temperature = 0.0
+# MAGIC GROUP BY n.prompt_sha256;
+# MAGIC
+# MAGIC -- They are sent in batches of $annotate_batch_size reviews per call, but never more than 10: the JSON of a larger batch
+# MAGIC -- can exceed the output token limit of the model and be cut off, and then none of its reviews can be parsed
+# MAGIC WITH batches AS (
+# MAGIC   SELECT FLOOR((ROW_NUMBER() OVER (ORDER BY review_id) - 1) / LEAST($annotate_batch_size, 10)) AS batch_id,
+# MAGIC     NAMED_STRUCT('id', review_id, 'product', product_title, 'body', review_body) AS review
+# MAGIC   FROM annotation_cache_misses
+# MAGIC ),
+# MAGIC batch_annotations AS (
+# MAGIC   -- Annotate our reviews using Azure OpenAI
+# MAGIC   SELECT ANNOTATE_REVIEWS_BATCH(COLLECT_LIST(review)) AS annotated
+# MAGIC   FROM batches
+# MAGIC   GROUP BY batch_id
+# MAGIC ),
+# MAGIC review_annotations AS (
+# MAGIC   SELECT a.review_id, a.entities, a.followup_response
+# MAGIC   FROM batch_annotations LATERAL VIEW EXPLODE(annotated) t AS a
+# MAGIC )
+# MAGIC INSERT INTO llm_response_cache (function_name, prompt_sha256, model, temperature, response, created_at)
+# MAGIC SELECT 'ANNOTATE_AND_RESPOND', m.prompt_sha256, 'llmbricks-gpt-35-turbo', 0.0, TO_JSON(STRUCT(a.entities AS entities, a.followup_response AS followup_response)), CURRENT_TIMESTAMP()
+# MAGIC FROM annotation_cache_misses m JOIN review_annotations a ON a.review_id = m.review_id
+# MAGIC -- The model may return the same review more than once: keep a single response per prompt
+# MAGIC QUALIFY ROW_NUMBER() OVER (PARTITION BY m.prompt_sha256 ORDER BY a.followup_response IS NULL, SIZE(a.entities) DESC) = 1
+
+# COMMAND ----------
+
+# DBTITLE 1,Annotate one at a time the reviews whose batch failed
+# MAGIC %sql
+# MAGIC -- Reviews still missing from the cache were in a batch whose response could not be parsed (or whose call failed).
+# MAGIC -- The same batch would be built again on the next run and fail the same way, so these are annotated one review per call
+# MAGIC WITH annotations AS (
+# MAGIC   SELECT prompt_sha256, ANNOTATE_AND_RESPOND(review_body, product_title) AS annotations
+# MAGIC   FROM annotation_cache_misses
+# MAGIC )
+# MAGIC INSERT INTO llm_response_cache (function_name, prompt_sha256, model, temperature, response, created_at)
+# MAGIC SELECT 'ANNOTATE_AND_RESPOND', prompt_sha256, 'llmbricks-gpt-35-turbo', 0.0, TO_JSON(annotations), CURRENT_TIMESTAMP()
+# MAGIC FROM annotations
+# MAGIC WHERE annotations IS NOT NULL
+
+# COMMAND ----------
+
+# DBTITLE 1,Load the annotations of new reviews from the cache into the Silver table
+# MAGIC %sql
+# MAGIC -- Only reviews not in the Silver table yet are carried into the MERGE
+# MAGIC WITH new_reviews AS (
+# MAGIC   SELECT b.* FROM bronze_customer_reviews_grocery b LEFT ANTI JOIN silver_reviews_annotated s ON b.review_id = s.review_id
+# MAGIC ),
+# MAGIC annotated_reviews AS (
+# MAGIC   SELECT n.*, FROM_JSON(c.response, "STRUCT<entities: ARRAY<STRUCT<entity_name: STRING, entity_type: STRING, entity_sentiment: STRING, followup: STRING, followup_reason: STRING>>, followup_response: STRING>") AS annotations
+# MAGIC   FROM (SELECT *, ANNOTATE_PROMPT_SHA256(review_body, product_title) AS prompt_sha256 FROM new_reviews) n
+# MAGIC   JOIN llm_response_cache c
+# MAGIC     ON c.function_name = 'ANNOTATE_AND_RESPOND' AND c.prompt_sha256 = n.prompt_sha256
+# MAGIC     AND c.model = 'llmbricks-gpt-35-turbo' AND c.temperature = 0.0
+# MAGIC   WHERE IS_FOLLOWUP_CANDIDATE(n.star_rating, n.review_body)
+# MAGIC   -- A prompt cached more than once (e.g. by the SQL and the cluster paths) must still give a single Silver row per review
+# MAGIC   QUALIFY ROW_NUMBER() OVER (PARTITION BY n.review_id ORDER BY c.created_at DESC) = 1
+# MAGIC   UNION ALL
+# MAGIC   -- Reviews that cannot require a follow-up get empty annotations without calling Azure OpenAI
+# MAGIC   SELECT *, CAST(NULL AS STRING) AS prompt_sha256, 
+# MAGIC     CAST(NAMED_STRUCT('entities', ARRAY(), 'followup_response', NULL) AS STRUCT<entities: ARRAY<STRUCT<entity_name: STRING, entity_type: STRING, entity_sentiment: STRING, followup: STRING, followup_reason: STRING>>, followup_response: STRING>) AS annotations
+# MAGIC   FROM new_reviews
+# MAGIC   WHERE NOT IS_FOLLOWUP_CANDIDATE(star_rating, review_body)
+# MAGIC )
+# MAGIC -- WITH SCHEMA EVOLUTION adds the followup_response field to the annotations struct of a Silver table
+# MAGIC -- created by an earlier version of this notebook, which CREATE TABLE IF NOT EXISTS above keeps as is
+# MAGIC MERGE WITH SCHEMA EVOLUTION INTO silver_reviews_annotated s USING annotated_reviews b
 # MAGIC ON b.review_id = s.review_id
 # MAGIC WHEN NOT MATCHED THEN 
 # MAGIC   INSERT (marketplace, customer_id, review_id, product_id, product_parent, product_title, star_rating, 
@@ -405,9 +707,7 @@ USE SCHEMA ${schema};
 # MAGIC     year, product_category, annotations)
 # MAGIC   VALUES (marketplace, customer_id, review_id, product_id, product_parent, product_title, star_rating, 
 # MAGIC     helpful_votes, total_votes, vine, verified_purchase, review_headline, review_body, review_date, 
-# MAGIC     year, product_category, 
-# MAGIC     -- Annotate our review using Azure OpenAI
-# MAGIC     ANNOTATE_REVIEW(review_body)); 
+# MAGIC     year, product_category, annotations); 
 
 # COMMAND ----------
 
@@ -417,30 +717,26 @@ USE SCHEMA ${schema};
 # COMMAND ----------
 
 # MAGIC %sql
-# MAGIC CREATE TABLE IF NOT EXISTS silver_reviews_processed
+# MAGIC -- One row per entity, derived from silver_reviews_annotated with no MERGE of its own:
+# MAGIC -- the refresh below processes the reviews annotated since the last one, incrementally where possible
+# MAGIC -- A silver_reviews_processed table created by an earlier version of this notebook must be dropped first:
+# MAGIC -- DROP TABLE silver_reviews_processed;
+# MAGIC CREATE MATERIALIZED VIEW IF NOT EXISTS silver_reviews_processed
+# MAGIC CLUSTER BY (review_id)
 # MAGIC COMMENT "Annotated reviews transformed for easier querying"
-# MAGIC AS SELECT *, "" AS entity_name, "" AS entity_type, "" AS entity_sentiment, "" AS followup_required, "" AS followup_reason
-# MAGIC FROM $data_table WHERE 1=0; -- Only duplicate the schema, don't copy data across
+# MAGIC AS SELECT a.* EXCEPT(annotations),
+# MAGIC   entity_details.entity_name AS entity_name,
+# MAGIC   LOWER(entity_details.entity_type) AS entity_type,
+# MAGIC   entity_details.entity_sentiment AS entity_sentiment,
+# MAGIC   entity_details.followup AS followup_required,
+# MAGIC   entity_details.followup_reason AS followup_reason,
+# MAGIC   a.annotations.followup_response AS followup_response
+# MAGIC FROM silver_reviews_annotated a LATERAL VIEW EXPLODE(a.annotations.entities) t AS entity_details
 
 # COMMAND ----------
 
 # MAGIC %sql
-# MAGIC WITH exploded AS (
-# MAGIC   SELECT * EXCEPT(annotations), 
-# MAGIC     EXPLODE(annotations.entities) AS entity_details
-# MAGIC   FROM silver_reviews_annotated
-# MAGIC ),
-# MAGIC columns_extracted AS (
-# MAGIC   SELECT * EXCEPT(entity_details),
-# MAGIC     entity_details.entity_name AS entity_name,
-# MAGIC     LOWER(entity_details.entity_type) AS entity_type,
-# MAGIC     entity_details.entity_sentiment AS entity_sentiment,
-# MAGIC     entity_details.followup AS followup_required,
-# MAGIC     entity_details.followup_reason AS followup_reason
-# MAGIC   FROM exploded
-# MAGIC )
-# MAGIC MERGE INTO silver_reviews_processed p USING columns_extracted c ON c.review_id = p.review_id
-# MAGIC WHEN NOT MATCHED THEN INSERT *
+# MAGIC REFRESH MATERIALIZED VIEW silver_reviews_processed
 
 # COMMAND ----------
 
@@ -461,14 +757,25 @@ USE SCHEMA ${schema};
 # MAGIC   customer_id STRING, review_id STRING, product_id STRING, product_title STRING, product_category STRING, 
 # MAGIC   star_rating INT, review_date DATE, review_body STRING
 # MAGIC )
-# MAGIC COMMENT "Cleansed customer reviews";
+# MAGIC CLUSTER BY (review_id)
+# MAGIC COMMENT "Cleansed customer reviews"
+# MAGIC TBLPROPERTIES ('delta.enableDeletionVectors' = true);
 # MAGIC
 # MAGIC CREATE TABLE IF NOT EXISTS gold_customer_followups_required (
 # MAGIC   customer_id STRING, review_id STRING, product_id STRING, product_title STRING, star_rating INT,
 # MAGIC   review_date DATE, review_body STRING, entity_name STRING, entity_type STRING, entity_sentiment STRING, 
 # MAGIC   followup_required STRING, followup_reason STRING, followup_response STRING
 # MAGIC )
-# MAGIC COMMENT "Customers that require follow up including sample response";
+# MAGIC CLUSTER BY (review_id)
+# MAGIC COMMENT "Customers that require follow up including sample response"
+# MAGIC -- Deletion vectors let the response backfill below update rows without rewriting their whole files
+# MAGIC TBLPROPERTIES ('delta.enableDeletionVectors' = true);
+# MAGIC
+# MAGIC -- Also for tables created by an earlier version of this notebook
+# MAGIC ALTER TABLE gold_customer_reviews CLUSTER BY (review_id);
+# MAGIC ALTER TABLE gold_customer_reviews SET TBLPROPERTIES ('delta.enableDeletionVectors' = true);
+# MAGIC ALTER TABLE gold_customer_followups_required CLUSTER BY (review_id);
+# MAGIC ALTER TABLE gold_customer_followups_required SET TBLPROPERTIES ('delta.enableDeletionVectors' = true);
 
 # COMMAND ----------
 
@@ -479,9 +786,11 @@ USE SCHEMA ${schema};
 # COMMAND ----------
 
 # MAGIC %sql
+# MAGIC -- The follow-up response was drafted together with the annotations, so this is a pure projection of the Silver layer
+# MAGIC -- Responses the annotation came back without are generated by the next two cells
 # MAGIC WITH followups_required AS (
 # MAGIC   SELECT customer_id, review_id, product_id, product_title, star_rating, review_date, review_body, 
-# MAGIC     entity_name, entity_type, entity_sentiment, followup_required, followup_reason
+# MAGIC     entity_name, entity_type, entity_sentiment, followup_required, followup_reason, followup_response
 # MAGIC   FROM silver_reviews_processed
 # MAGIC   WHERE followup_required = "Y"
 # MAGIC )
@@ -491,10 +800,46 @@ USE SCHEMA ${schema};
 # MAGIC   INSERT (customer_id, review_id, product_id, product_title, star_rating, review_date, review_body, 
 # MAGIC     entity_name, entity_type, entity_sentiment, followup_required, followup_reason, followup_response)
 # MAGIC   VALUES (customer_id, review_id, product_id, product_title, star_rating, review_date, review_body, 
-# MAGIC     entity_name, entity_type, entity_sentiment, followup_required, followup_reason, 
-# MAGIC     -- Generate a customer response
-# MAGIC     GENERATE_RESPONSE(product_title, 
-# MAGIC     entity_name, followup_reason))
+# MAGIC     entity_name, entity_type, entity_sentiment, followup_required, followup_reason, followup_response)
+
+# COMMAND ----------
+
+# DBTITLE 1,Generate the follow-up responses still missing from the Gold table
+# MAGIC %sql
+# MAGIC -- Follow-ups whose annotation came back without a response get one from a separate, short GENERATE_RESPONSE call
+# MAGIC -- Only prompts that were never answered before are sent to Azure OpenAI; failed calls are retried on the next run
+# MAGIC WITH prompts AS (
+# MAGIC   SELECT DISTINCT MAKE_RESPONSE_PROMPT(product_title, entity_name, followup_reason) AS prompt
+# MAGIC   FROM gold_customer_followups_required
+# MAGIC   WHERE followup_response IS NULL
+# MAGIC ),
+# MAGIC responses AS (
+# MAGIC   SELECT SHA2(p.prompt, 256) AS prompt_sha256, PROMPT_HANDLER_SHORT(p.prompt) AS response
+# MAGIC   FROM prompts p LEFT ANTI JOIN llm_response_cache c
+# MAGIC     ON c.function_name = 'GENERATE_RESPONSE' AND c.prompt_sha256 = SHA2(p.prompt, 256)
+# MAGIC     AND c.model = 'llmbricks-gpt-35-turbo' AND c.temperature = 0.0
+# MAGIC )
+# MAGIC INSERT INTO llm_response_cache (function_name, prompt_sha256, model, temperature, response, created_at)
+# MAGIC SELECT 'GENERATE_RESPONSE', prompt_sha256, 'llmbricks-gpt-35-turbo', 0.0, response, CURRENT_TIMESTAMP()
+# MAGIC FROM responses
+# MAGIC WHERE response IS NOT NULL
+
+# COMMAND ----------
+
+# DBTITLE 1,Load the generated responses from the cache into the Gold table
+# MAGIC %sql
+# MAGIC WITH responses AS (
+# MAGIC   SELECT g.review_id, g.entity_name, FIRST(c.response) AS followup_response
+# MAGIC   FROM gold_customer_followups_required g JOIN llm_response_cache c
+# MAGIC     ON c.function_name = 'GENERATE_RESPONSE'
+# MAGIC     AND c.prompt_sha256 = SHA2(MAKE_RESPONSE_PROMPT(g.product_title, g.entity_name, g.followup_reason), 256)
+# MAGIC     AND c.model = 'llmbricks-gpt-35-turbo' AND c.temperature = 0.0
+# MAGIC   WHERE g.followup_response IS NULL
+# MAGIC   GROUP BY g.review_id, g.entity_name
+# MAGIC )
+# MAGIC MERGE INTO gold_customer_followups_required g USING responses r
+# MAGIC ON r.review_id = g.review_id AND r.entity_name = g.entity_name
+# MAGIC WHEN MATCHED AND g.followup_response IS NULL THEN UPDATE SET followup_response = r.followup_response
 
 # COMMAND ----------
 
@@ -503,6 +848,180 @@ USE SCHEMA ${schema};
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Calling Azure OpenAI concurrently from a cluster
+# MAGIC
+# MAGIC `ai_query()` already sends the requests of a query concurrently. When Model Serving endpoints are not available, or to control concurrency yourself, the same prompts can be sent straight to Azure OpenAI from a Databricks cluster with a Pandas UDF that issues the requests concurrently with `asyncio`, while staying under the deployment's requests-per-minute quota with a semaphore.
+# MAGIC
+# MAGIC The UDFs only replace the transport: prompts are still built by `ANNOTATE_REVIEWS_PROMPT()` and `MAKE_RESPONSE_PROMPT()` and responses parsed by `PARSE_REVIEWS_ANNOTATIONS()`, and the results land in the same `llm_response_cache` table the Silver and Gold `MERGE`s read from.
+# MAGIC
+# MAGIC **NOTE: Run this section on a Unity Catalog enabled cluster (DBR 13.3 LTS or above), not in DBSQL**
+
+# COMMAND ----------
+
+# MAGIC %pip install "openai>=1.0"
+
+# COMMAND ----------
+
+# DBTITLE 1,Define prompt_handler_json_udf() and prompt_handler_short_udf() - async Azure OpenAI calls from Pandas UDFs
+import asyncio
+
+import openai
+import pandas as pd
+from pyspark.sql.functions import pandas_udf
+
+# Same Azure OpenAI deployment as PROMPT_HANDLER(), with an API version that supports JSON mode as in PROMPT_HANDLER_JSON()
+AZURE_OPENAI_ENDPOINT = "https://llmbricks.openai.azure.com/"
+AZURE_OPENAI_DEPLOYMENT = "llmbricks"
+AZURE_OPENAI_API_VERSION = "2024-02-01"
+# Model Serving endpoint of the same deployment: responses are cached under its name whichever path produced them
+AZURE_OPENAI_MODEL_ENDPOINT = "llmbricks-gpt-35-turbo"
+# Concurrent requests per Spark task
+MAX_CONCURRENT_REQUESTS = 8
+# Requests-per-minute quota of the deployment, and requests one task sends per minute
+# (MAX_CONCURRENT_REQUESTS in flight, each taking about 8 seconds)
+AZURE_OPENAI_RPM_LIMIT = 480
+REQUESTS_PER_MINUTE_PER_TASK = 60
+# Spark tasks sending requests at the same time - as many as the quota allows
+NUM_CONCURRENCY = max(1, AZURE_OPENAI_RPM_LIMIT // REQUESTS_PER_MINUTE_PER_TASK)
+
+api_key = dbutils.secrets.get("SCOPE NAME", "OPEN API KEY VALUE")
+
+spark.sql(f"USE CATALOG {dbutils.widgets.get('catalog')}")
+spark.sql(f"USE SCHEMA {dbutils.widgets.get('schema')}")
+
+
+async def complete_prompts(prompts, **params):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with openai.AsyncAzureOpenAI(
+        api_key=api_key,
+        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+        api_version=AZURE_OPENAI_API_VERSION,
+    ) as client:
+
+        async def complete(prompt):
+            async with semaphore:
+                try:
+                    response = await client.chat.completions.create(
+                        model=AZURE_OPENAI_DEPLOYMENT,
+                        messages=[{"role": "user", "content": prompt}],
+                        temperature=0.0,
+                        **params,
+                    )
+                except openai.OpenAIError:
+                    # Failed rows come back as NULL and are retried on the next run
+                    return None
+                return response.choices[0].message.content
+
+        return await asyncio.gather(*[complete(prompt) for prompt in prompts])
+
+
+# Python counterpart of PROMPT_HANDLER_JSON(): every prompt of an Arrow batch is sent concurrently
+@pandas_udf("string")
+def prompt_handler_json_udf(prompts: pd.Series) -> pd.Series:
+    return pd.Series(asyncio.run(complete_prompts(prompts, response_format={"type": "json_object"})))
+
+
+# Non-deterministic, so that Spark never evaluates it twice for a row (e.g. by pushing a filter on its result below it)
+prompt_handler_json_udf = prompt_handler_json_udf.asNondeterministic()
+spark.udf.register("prompt_handler_json_udf", prompt_handler_json_udf)
+
+
+# Python counterpart of PROMPT_HANDLER_SHORT()
+@pandas_udf("string")
+def prompt_handler_short_udf(prompts: pd.Series) -> pd.Series:
+    return pd.Series(asyncio.run(complete_prompts(prompts, max_tokens=180, stop=["\n\nCustomer:", "###"])))
+
+
+prompt_handler_short_udf = prompt_handler_short_udf.asNondeterministic()
+spark.udf.register("prompt_handler_short_udf", prompt_handler_short_udf)
+
+# COMMAND ----------
+
+# DBTITLE 1,Annotate new reviews that are not in the cache yet with prompt_handler_json_udf()
+from pyspark.sql.functions import current_timestamp, expr, lit, to_json
+
+cache_misses = spark.sql(f"""
+    WITH new_reviews AS (
+      SELECT b.review_id, b.product_title, b.review_body, ANNOTATE_PROMPT_SHA256(b.review_body, b.product_title) AS prompt_sha256
+      FROM bronze_customer_reviews_grocery b LEFT ANTI JOIN silver_reviews_annotated s ON b.review_id = s.review_id
+      WHERE IS_FOLLOWUP_CANDIDATE(b.star_rating, b.review_body)
+    )
+    SELECT n.prompt_sha256, MIN(n.review_id) AS review_id, FIRST(n.product_title) AS product_title, FIRST(n.review_body) AS review_body
+    FROM new_reviews n LEFT ANTI JOIN llm_response_cache c
+      ON c.function_name = 'ANNOTATE_AND_RESPOND' AND c.prompt_sha256 = n.prompt_sha256
+      AND c.model = '{AZURE_OPENAI_MODEL_ENDPOINT}' AND c.temperature = 0.0
+    GROUP BY n.prompt_sha256
+""")
+
+# Bronze files are few and small, so the reviews would otherwise be annotated by one or two tasks:
+# spread them over NUM_CONCURRENCY tasks so the requests are sent from several executors at once
+# One prompt per review: concurrency replaces batching on this path
+(
+    cache_misses.repartition(NUM_CONCURRENCY, "review_id")
+    .withColumn("annotated", expr("""
+        TRY_ELEMENT_AT(PARSE_REVIEWS_ANNOTATIONS(prompt_handler_json_udf(
+          ANNOTATE_REVIEWS_PROMPT(ARRAY(NAMED_STRUCT('id', review_id, 'product', product_title, 'body', review_body))))), 1)
+    """))
+    .where("annotated IS NOT NULL")
+    .select(
+        lit("ANNOTATE_AND_RESPOND").alias("function_name"),
+        "prompt_sha256",
+        lit(AZURE_OPENAI_MODEL_ENDPOINT).alias("model"),
+        lit(0.0).alias("temperature"),
+        to_json(expr("STRUCT(annotated.entities AS entities, annotated.followup_response AS followup_response)")).alias("response"),
+        current_timestamp().alias("created_at"),
+    )
+    .write.mode("append")
+    .saveAsTable("llm_response_cache")
+)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Re-run the Silver `MERGE` and the refresh of `silver_reviews_processed` above to load the new annotations from `llm_response_cache`
+
+# COMMAND ----------
+
+# DBTITLE 1,Generate the follow-up responses still missing from the Gold table with prompt_handler_short_udf()
+# Prompts of the follow-ups whose annotation came back without a response, and that were never answered before
+cache_misses = spark.sql(f"""
+    WITH prompts AS (
+      SELECT DISTINCT MAKE_RESPONSE_PROMPT(product_title, entity_name, followup_reason) AS prompt
+      FROM gold_customer_followups_required
+      WHERE followup_response IS NULL
+    )
+    SELECT p.prompt, SHA2(p.prompt, 256) AS prompt_sha256
+    FROM prompts p LEFT ANTI JOIN llm_response_cache c
+      ON c.function_name = 'GENERATE_RESPONSE' AND c.prompt_sha256 = SHA2(p.prompt, 256)
+      AND c.model = '{AZURE_OPENAI_MODEL_ENDPOINT}' AND c.temperature = 0.0
+""")
+
+num_cache_misses = cache_misses.count()
+if num_cache_misses > 0:
+    # Spread the prompts over several tasks so that their requests are sent from several executors at once
+    (
+        cache_misses.repartition(min(num_cache_misses, NUM_CONCURRENCY))
+        .select(
+            lit("GENERATE_RESPONSE").alias("function_name"),
+            "prompt_sha256",
+            lit(AZURE_OPENAI_MODEL_ENDPOINT).alias("model"),
+            lit(0.0).alias("temperature"),
+            prompt_handler_short_udf("prompt").alias("response"),
+            current_timestamp().alias("created_at"),
+        )
+        .where("response IS NOT NULL")
+        .write.mode("append")
+        .saveAsTable("llm_response_cache")
+    )
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Re-run the Gold `MERGE` of the generated responses above to load them from `llm_response_cache`
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Scribbles
 